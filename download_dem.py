@@ -10,10 +10,18 @@
 
 import sys
 import math
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import closing
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import rasterio
 from rasterio.transform import from_bounds
+from rasterio.windows import Window, transform as window_transform
 from pathlib import Path
 import argparse
 from PIL import Image
@@ -44,12 +52,27 @@ def num2deg(x, y, zoom):
     lat = math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y / n))))
     return lat, lon
 
+def deg2num_vec(lat, lon, zoom):
+    """deg2num の配列版（lat, lon は ndarray / スカラーどちらでも可）"""
+    lat_r = np.radians(lat)
+    n = 2.0 ** zoom
+    x = ((np.asarray(lon) + 180.0) / 360.0 * n).astype(np.int64)
+    y = ((1.0 - np.log(np.tan(lat_r) + 1.0 / np.cos(lat_r)) / np.pi) / 2.0 * n).astype(np.int64)
+    return x, y
+
+def num2deg_vec(x, y, zoom):
+    """num2deg の配列版（タイル左上隅の緯度経度を一括計算）"""
+    n = 2.0 ** zoom
+    lon = np.asarray(x) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(y) / n))))
+    return lat, lon
+
 
 # ──────────────────────────────────────────────
 # PNG → 標高変換
 # ──────────────────────────────────────────────
 
-def png_to_elevation(png_bytes):
+def png_to_elevation(png_bytes, out=None):
     """
     国土地理院標高タイル（PNG）から標高配列を生成
 
@@ -58,23 +81,33 @@ def png_to_elevation(png_bytes):
       x < 8388608  → elevation = x * 0.01 [m]  (正の標高)
       x == 8388608 → NoData  (RGB = 128, 0, 0)
       x > 8388608  → elevation = (x - 16777216) * 0.01 [m]  (負の標高)
+
+    out を渡すとその float32 配列に書き込んで返す（新しい配列を確保しない）
     """
-    img = Image.open(BytesIO(png_bytes)).convert('RGB')
-    arr = np.array(img, dtype=np.uint32)
+    img = Image.open(BytesIO(png_bytes))
+    if img.mode == 'RGB':
+        arr = np.asarray(img, dtype=np.uint8)
+    elif img.mode == 'RGBA':       # アルファは使わないのでRGBだけをビューで取り出す
+        arr = np.asarray(img, dtype=np.uint8)[:, :, :3]
+    else:                          # パレットPNG等はRGBへ変換
+        arr = np.asarray(img.convert('RGB'), dtype=np.uint8)
 
-    r, g, b = arr[:, :, 0], arr[:, :, 1], arr[:, :, 2]
-    x = r * 65536 + g * 256 + b
+    # RGB を big-endian int32 の上位3バイトに置いて読み替え、算術シフトで
+    # 24bit の2の補数をそのまま符号付き整数に戻す（パックと符号処理を1パスで）
+    buf = np.zeros(arr.shape[:2] + (4,), dtype=np.uint8)
+    buf[:, :, :3] = arr
+    x = buf.view('>i4')[:, :, 0] >> 8
 
-    elev = np.where(
-        x < 8388608,
-        x.astype(np.float32) * 0.01,                    # 正の標高
-        (x.astype(np.float32) - 16777216.0) * 0.01      # 負の標高
-    )
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    elev = out
+    elev[...] = x
+    elev *= 0.01
 
-    # NoData: x == 8388608 (RGB = 128, 0, 0)
-    elev[x == 8388608] = np.nan
+    # NoData: x == 8388608 (RGB = 128, 0, 0) → 符号反転後は -8388608
+    elev[x == -8388608] = np.nan
 
-    return elev.astype(np.float32)
+    return elev
 
 
 # ──────────────────────────────────────────────
@@ -84,6 +117,8 @@ def png_to_elevation(png_bytes):
 class TileDownloader:
 
     SOURCES = ['dem5a_png', 'dem5b_png', 'dem_png']
+    TIMEOUT = (3, 10)   # (接続, 読み込み) 秒
+    NEG_TTL = 30 * 24 * 3600   # 404 の記録は30日で失効（後から DEM5A/5B が整備されることがある）
 
     def __init__(self, cache_dir='tiles_cache', max_workers=10):
         self.cache_dir = Path(cache_dir)
@@ -91,65 +126,184 @@ class TileDownloader:
         self.session = requests.Session()
         self.session.headers['User-Agent'] = 'Mozilla/5.0'
 
-    def _cache(self, zoom, x, y):
-        return self.cache_dir / str(zoom) / str(x) / f"{y}.npy"
+        # 全ワーカーで1つのSessionを共有し、keep-alive接続を使い回す。
+        # 既定のプールは10本なので、ワーカー数 × ソース数に合わせて広げる
+        # （溢れた接続が捨てられてTLSハンドシェイクが繰り返されるのを防ぐ）
+        retry = Retry(total=4, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=max_workers,
+                              pool_maxsize=max_workers * len(self.SOURCES),
+                              max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # 404（そのソースにタイルが存在しない）を記録しておき、
+        # 次回以降の実行では同じURLを取りに行かない。
+        # 記録は SQLite に持つ（GUI と CLI など複数プロセスが同時に使っても壊れない）。
+        # 起動時に有効期限内のキーを読み込み、新しい 404 は close() でまとめて書き込む
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._neg_path = self.cache_dir / 'neg_cache.sqlite'
+        self._neg_lock = threading.Lock()
+        self._neg_new = []
+        try:
+            with closing(self._neg_connect()) as db:
+                self.neg_cache = {key for (key,) in db.execute(
+                    'SELECT key FROM neg WHERE ts > ?', (time.time() - self.NEG_TTL,))}
+        except sqlite3.Error:
+            self.neg_cache = set()
+
+        # ワーカースレッドごとに使い回す下位ソース復号用の作業バッファ
+        self._tls = threading.local()
+
+        # タイルキャッシュの保存は専用スレッドに任せ、ワーカーはディスクI/Oを待たない
+        self._save_q = queue.Queue()
+        self._saver = threading.Thread(target=self._save_loop, daemon=True)
+        self._saver.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._save_q.put(None)   # 保存スレッドを終了させる（それまでの保存は済ませてから）
+        self._saver.join()
+        self._flush_neg_cache()
+        self.session.close()
+
+    def _neg_connect(self):
+        db = sqlite3.connect(str(self._neg_path), timeout=30)
+        db.execute('CREATE TABLE IF NOT EXISTS neg (key TEXT PRIMARY KEY, ts REAL NOT NULL)')
+        return db
+
+    def _flush_neg_cache(self):
+        with self._neg_lock:
+            new, self._neg_new = self._neg_new, []
+        if not new:
+            return
+        now = time.time()
+        try:
+            # 1トランザクションで追加し、期限切れの行も掃除する
+            with closing(self._neg_connect()) as db, db:
+                db.executemany('INSERT OR REPLACE INTO neg (key, ts) VALUES (?, ?)',
+                               [(key, now) for key in new])
+                db.execute('DELETE FROM neg WHERE ts <= ?', (now - self.NEG_TTL,))
+        except sqlite3.Error:
+            pass
+
+    def _cache(self, src, zoom, x, y):
+        # 復号済み配列ではなく取得したPNGをソース別にそのまま保存する
+        # （float32の1/8〜1/16の容量で、合成ロジックを変えても再取得不要）
+        return self.cache_dir / src / str(zoom) / str(x) / f"{y}.png"
+
+    def _save_loop(self):
+        while True:
+            item = self._save_q.get()
+            if item is None:
+                self._save_q.task_done()
+                return
+            path, data = item
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+            except Exception:
+                pass
+            finally:
+                self._save_q.task_done()
 
-    def download_one(self, x, y, zoom):
-        cache = self._cache(zoom, x, y)
-        cache.parent.mkdir(parents=True, exist_ok=True)
+    def _fetch(self, src, zoom, x, y, out=None):
+        key = f"{src}/{zoom}/{x}/{y}"
+        if key in self.neg_cache:
+            return None
 
+        cache = self._cache(src, zoom, x, y)
         if cache.exists():
             try:
-                return x, y, np.load(cache)
+                return png_to_elevation(cache.read_bytes(), out=out)
             except Exception:
                 cache.unlink()
 
-        # 3ソースを全て取得してピクセル単位で補完
-        # DEM5A（レーザー測量）→ DEM5B（写真測量）→ DEM10B（広域）の順で優先
-        layers = []
+        url = f"https://cyberjapandata.gsi.go.jp/xyz/{key}.png"
+        try:
+            resp = self.session.get(url, timeout=self.TIMEOUT)
+            if resp.status_code == 200:
+                elev = png_to_elevation(resp.content, out=out)
+                self._save_q.put((cache, resp.content))
+                return elev
+            if resp.status_code == 404:
+                with self._neg_lock:
+                    self.neg_cache.add(key)
+                    self._neg_new.append(key)
+        except Exception:
+            pass
+        return None
+
+    def download_one(self, x, y, zoom, out=None):
+        """
+        1タイルを取得・合成して (x, y, 標高配列) を返す。
+        out を渡すと合成結果をそこへ直接書き込む（download_all はタイル格子の
+        スロットを渡すので、タイルごとの配列確保とコピーが発生しない）
+        """
+        if out is None:
+            out = np.empty((256, 256), dtype=np.float32)
+        scratch = getattr(self._tls, 'scratch', None)
+        if scratch is None:
+            scratch = self._tls.scratch = np.empty((256, 256), dtype=np.float32)
+
+        # DEM5A（レーザー測量）→ DEM5B（写真測量）→ DEM10B（広域）の順で優先。
+        # 上位ソースでNaNが残ったときだけ次のソースを取りに行き、
+        # NaNの箇所だけを埋める（DEM5Aで埋まる地域では1リクエストで済む）
+        # missing: まだ有効値が入っていない画素（NaN判定は各ソース1回だけ）
+        missing = None
         for src in self.SOURCES:
-            url = f"https://cyberjapandata.gsi.go.jp/xyz/{src}/{zoom}/{x}/{y}.png"
-            try:
-                resp = self.session.get(url, timeout=10)
-                if resp.status_code == 200:
-                    layers.append(png_to_elevation(resp.content))
-                else:
-                    layers.append(None)
-            except Exception:
-                layers.append(None)
-
-        # ピクセル単位で補完: 上位ソースがNaNの箇所を下位ソースで埋める
-        result = np.full((256, 256), np.nan, dtype=np.float32)
-        for layer in layers:
+            layer = self._fetch(src, zoom, x, y,
+                                out=out if missing is None else scratch)
             if layer is None:
                 continue
-            # まだNaNの箇所だけ埋める
-            mask = np.isnan(result) & ~np.isnan(layer)
-            result[mask] = layer[mask]
-            # 全ピクセルが埋まったら終了
-            if not np.any(np.isnan(result)):
+            if missing is None:
+                missing = np.isnan(out)
+            else:
+                newly_filled = missing & ~np.isnan(layer)
+                out[newly_filled] = layer[newly_filled]
+                missing &= ~newly_filled
+            if not missing.any():
                 break
 
-        np.save(cache, result)
-        return x, y, result
+        if missing is None:
+            out.fill(np.nan)
+
+        return x, y, out
 
     def download_all(self, tiles, zoom, progress_callback=None):
-        results = {}
+        """
+        tiles を並列取得し、(ny, nx, 256, 256) のタイル格子で返す。
+        格子の [ty - y_min, tx - x_min] に各タイルが入る（取得失敗はNaN）。
+        """
+        x_min = min(tx for tx, _ in tiles)
+        y_min = min(ty for _, ty in tiles)
+        nx = max(tx for tx, _ in tiles) - x_min + 1
+        ny = max(ty for _, ty in tiles) - y_min + 1
+        # 各ワーカーは自分のスロットにだけ書くので重なりはない
+        grid = np.full((ny, nx, 256, 256), np.nan, dtype=np.float32)
+
         total = len(tiles)
         with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
-            futures = {pool.submit(self.download_one, x, y, zoom): (x, y)
+            futures = {pool.submit(self.download_one, x, y, zoom,
+                                   grid[y - y_min, x - x_min]): (x, y)
                        for x, y in tiles}
             for done_count, f in enumerate(tqdm(as_completed(futures), total=total,
                           desc="ダウンロード", unit="枚"), 1):
                 x, y = futures[f]
                 try:
-                    _, _, data = f.result()
-                    results[(x, y)] = data
+                    f.result()
                 except Exception:
-                    results[(x, y)] = np.full((256, 256), np.nan, dtype=np.float32)
+                    grid[y - y_min, x - x_min].fill(np.nan)
                 if progress_callback:
                     progress_callback(done_count, total)
-        return results
+
+        self._save_q.join()
+        return grid
 
 
 # ──────────────────────────────────────────────
@@ -171,8 +325,9 @@ def create_geotiff(lat_min, lat_max, lon_min, lon_max,
     print(f"範囲: {lat_min:.4f}～{lat_max:.4f}°N, {lon_min:.4f}～{lon_max:.4f}°E")
     print(f"ズームレベル: {zoom}")
 
-    x_min, y_min = deg2num(lat_max, lon_min, zoom)
-    x_max, y_max = deg2num(lat_min, lon_max, zoom)
+    # 北西・南東の2隅をまとめて変換
+    (x_min, x_max), (y_min, y_max) = (
+        v.tolist() for v in deg2num_vec([lat_max, lat_min], [lon_min, lon_max], zoom))
     
     print(f"タイル範囲計算:")
     print(f"  deg2num({lat_max:.6f}, {lon_min:.6f}) = ({x_min}, {y_min})")
@@ -190,73 +345,77 @@ def create_geotiff(lat_min, lat_max, lon_min, lon_max,
              for ty in range(y_min, y_max + 1)
              for tx in range(x_min, x_max + 1)]
 
-    downloader = TileDownloader(max_workers=max_workers)
-    tile_data = downloader.download_all(tiles, zoom, progress_callback=progress_callback)
+    with TileDownloader(max_workers=max_workers) as downloader:
+        tile_grid = downloader.download_all(tiles, zoom, progress_callback=progress_callback)
 
-    # タイルを結合
+    # タイル格子 (ny, nx, 256, 256) を1回のコピーで (ny*256, nx*256) に結合
     TILE = 256
     height, width = ny * TILE, nx * TILE
-    elevation = np.full((height, width), np.nan, dtype=np.float32)
-
-    for ty in range(y_min, y_max + 1):
-        for tx in range(x_min, x_max + 1):
-            data = tile_data.get((tx, ty))
-            if data is not None:
-                r0 = (ty - y_min) * TILE
-                c0 = (tx - x_min) * TILE
-                elevation[r0:r0 + TILE, c0:c0 + TILE] = data
-
-    valid = elevation[~np.isnan(elevation)]
-    if len(valid) == 0:
-        print("❌ 有効なデータが取得できませんでした")
-        print("   インターネット接続と座標範囲（日本国内）を確認してください")
-        return False
+    elevation = tile_grid.transpose(0, 2, 1, 3).reshape(height, width)
 
     # ── タイルモザイクの実際の座標範囲 ──────────────────────────────
-    lat_max_actual, lon_min_actual = num2deg(x_min,     y_min,     zoom)
-    lat_min_actual, lon_max_actual = num2deg(x_max + 1, y_max + 1, zoom)
+    (lat_max_actual, lat_min_actual), (lon_min_actual, lon_max_actual) = (
+        v.tolist() for v in num2deg_vec([x_min, x_max + 1], [y_min, y_max + 1], zoom))
 
     # ── 要求座標にクロップしてアスペクト比を正しく保持 ──────────────
-    # タイル1ピクセルあたりの度数を計算
-    deg_per_px_lon = (lon_max_actual - lon_min_actual) / width
-    deg_per_px_lat = (lat_max_actual - lat_min_actual) / height  # 正値（上が大）
+    # モザイク全体の変換行列から、要求範囲に対応するウィンドウを切り出す
+    full_transform = from_bounds(lon_min_actual, lat_min_actual,
+                                 lon_max_actual, lat_max_actual,
+                                 width, height)
+    deg_per_px_lon = full_transform.a
+    deg_per_px_lat = -full_transform.e  # 正値（上が大）
 
     # 要求座標に対応するピクセル範囲（rowは上=lat_max_actual側が0）
-    col_start = int((lon_min - lon_min_actual) / deg_per_px_lon)
-    col_end   = int((lon_max - lon_min_actual) / deg_per_px_lon)
-    row_start = int((lat_max_actual - lat_max) / deg_per_px_lat)
-    row_end   = int((lat_max_actual - lat_min) / deg_per_px_lat)
-
-    # 範囲をクランプ（タイル境界の丸め誤差でアレイ外になることを防ぐ）
-    col_start = max(0, col_start)
-    col_end   = min(width,  max(col_end,  col_start + 1))
-    row_start = max(0, row_start)
-    row_end   = min(height, max(row_end,  row_start + 1))
-
-    elevation = elevation[row_start:row_end, col_start:col_end]
+    # タイル境界の丸め誤差でアレイ外にならないようクランプする
+    col_start, col_end = np.clip(
+        [int((lon_min - lon_min_actual) / deg_per_px_lon),
+         int((lon_max - lon_min_actual) / deg_per_px_lon)], 0, width).tolist()
+    row_start, row_end = np.clip(
+        [int((lat_max_actual - lat_max) / deg_per_px_lat),
+         int((lat_max_actual - lat_min) / deg_per_px_lat)], 0, height).tolist()
+    col_start = min(col_start, width - 1)
+    row_start = min(row_start, height - 1)
+    col_end = max(col_end, col_start + 1)
+    row_end = max(row_end, row_start + 1)
+
+    window = Window(col_start, row_start, col_end - col_start, row_end - row_start)
+    elevation = elevation[window.toslices()]
     height, width = elevation.shape
+    transform = window_transform(window, full_transform)
 
-    # クロップ後の正確な座標範囲を再計算
-    lon_min_actual = lon_min_actual + col_start * deg_per_px_lon
-    lon_max_actual = lon_min_actual + width      * deg_per_px_lon
-    lat_max_actual = lat_max_actual - row_start  * deg_per_px_lat
-    lat_min_actual = lat_max_actual - height     * deg_per_px_lat
+    # 有効データ数・標高範囲は実際に書き出すクロップ後の範囲で数える
+    # （有効値のコピーは作らず、マスクと where 付きの min/max で済ませる）
+    finite = np.isfinite(elevation)
+    n_valid = int(finite.sum())
+    if n_valid == 0:
+        print("❌ 有効なデータが取得できませんでした")
+        print("   インターネット接続と座標範囲（日本国内）を確認してください")
+        return False
+    vmin = float(elevation.min(where=finite, initial=np.inf))
+    vmax = float(elevation.max(where=finite, initial=-np.inf))
 
-    print(f"✅ 有効データ: {(~np.isnan(elevation)).sum():,}px")
-    print(f"   標高範囲: {np.nanmin(elevation):.1f}m ～ {np.nanmax(elevation):.1f}m")
+    print(f"✅ 有効データ: {n_valid:,}px")
+    print(f"   標高範囲: {vmin:.1f}m ～ {vmax:.1f}m")
     print(f"   出力サイズ: {width} x {height}px  ({'横長' if width > height else '縦長' if height > width else '正方形'})")
 
-    transform = from_bounds(lon_min_actual, lat_min_actual,
-                            lon_max_actual, lat_max_actual,
-                            width, height)
-
-    out = np.where(np.isnan(elevation), -9999.0, elevation)
-    with rasterio.open(output_file, 'w',
-                       driver='GTiff', height=height, width=width,
-                       count=1, dtype=np.float32,
-                       crs='EPSG:4326', transform=transform,
-                       nodata=-9999, compress='lzw') as dst:
-        dst.write(out, 1)
+    # ブロックキャッシュを広げ、DEFLATE 圧縮は num_threads で全コア並列にする
+    with rasterio.Env(GDAL_CACHEMAX=512):
+        # GDAL の COG ドライバで、内部タイル＋オーバービュー付きの
+        # Cloud-Optimized GeoTIFF を1パスで書き出す（タイルサーバー等でそのまま読める）
+        with rasterio.open(output_file, 'w',
+                           driver='COG', height=height, width=width,
+                           count=1, dtype=np.float32,
+                           crs='EPSG:4326', transform=transform,
+                           nodata=-9999,
+                           # float32標高には浮動小数点predictor + DEFLATE が効く。
+                           # 256pxタイル化で元の標高タイル格子とも揃える
+                           compress='deflate', predictor=3, blocksize=256,
+                           overview_resampling='average',
+                           num_threads='all_cpus', bigtiff='IF_SAFER') as dst:
+            # COG ドライバは最終コピーまで全体をメモリに持つので、分割して書いても
+            # 省メモリにはならない。NaN → nodata はその場で置き換えて1回で書く
+            np.nan_to_num(elevation, copy=False, nan=-9999.0)
+            dst.write(elevation, 1)
 
     print(f"✅ 保存完了: {output_file}  ({width} x {height}px)")
     return True
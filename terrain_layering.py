@@ -10,14 +10,15 @@ GeoTIFF（dem.tif）から等高線レイヤーのSVGファイルを生成する
 """
 
 import argparse
+import math
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from xml.sax.saxutils import escape
 
 import numpy as np
-import rasterio
-import svgwrite
-from scipy.ndimage import binary_fill_holes, zoom, binary_dilation
-from skimage import measure
 
 try:
     from tqdm import tqdm
@@ -25,6 +26,11 @@ except ImportError:
     def tqdm(iterable, **kwargs):
         return iterable
 
+try:
+    import fill_voids   # スキャンライン塗りつぶし（binary_fill_holes より高速）
+except ImportError:
+    fill_voids = None
+
 
 # ──────────────────────────────────────────────
 # カスタムカラーマップ "topo"
@@ -46,7 +52,9 @@ def _register_topo_cmap():
     ], N=256)
     matplotlib.colormaps.register(cmap)
 
-_register_topo_cmap()
+
+class Cancelled(Exception):
+    """progress_callback から送出すると、進行中の処理（タイル取得など）を打ち切る"""
 
 
 # ──────────────────────────────────────────────
@@ -79,17 +87,44 @@ class TerrainLayerGenerator:
         self._topo_zoom        = 15         # zoom15: zoom14の4倍解像度
         self._topo_image       = None       # キャッシュ
         self._satellite_image  = None       # キャッシュ
+        self._raster_hrefs     = {}         # (colormap, 出力先) → 背景画像の相対パス
+        self._bucket           = None       # 各画素が何層目まで含まれるか（遅延計算）
+        self._level_index      = {}         # level → 層番号
+        self._level_count      = None       # 層番号 → その層に含まれる画素数
+
+        # rasterio / scipy は重いので、CLI の --help などで読み込まずに済むよう使う所で import
+        import rasterio
+        from rasterio.enums import Resampling
+        from scipy.ndimage import zoom
 
         print(f"DEMファイルを読み込み中: {dem_file}")
         t = time.time()
 
-        with rasterio.open(dem_file) as src:
-            raw          = src.read(1).astype(np.float32)
+        with rasterio.Env(GDAL_NUM_THREADS='ALL_CPUS', GDAL_CACHEMAX=512), \
+                rasterio.open(dem_file) as src:
             self.nodata  = src.nodata
             self.bounds  = src.bounds
-            orig_shape   = raw.shape
+            orig_shape   = (src.height, src.width)
             self.orig_shape = orig_shape  # gsi_topo用：ダウンサンプル前の解像度
 
+            # オーバービュー付き（download_dem.py の COG 出力など）なら、
+            # 全解像度を読んでから縮小せず GDAL に目標解像度で直接読ませる。
+            # ただしオーバービューは平均済みなので、海面除去（負の標高 → NaN）が効くと
+            # 海の画素が海岸の陸地に平均で混ざってしまう。nodata が宣言されていないと
+            # GDAL が縮小時に nodata を除外できない。どちらかに当たるなら全解像度で
+            # 読んで、マスクしてから縮小する
+            read_downsampled = (downsample < 1.0 and bool(src.overviews(1))
+                                and elev_range_min is not None
+                                and src.nodata is not None)
+            if read_downsampled:
+                out_shape = (int(round(src.height * downsample)),
+                             int(round(src.width * downsample)))
+                raw = src.read(1, out_shape=out_shape,
+                               resampling=Resampling.bilinear,
+                               masked=True).astype(np.float32).filled(np.nan)
+            else:
+                raw = src.read(1).astype(np.float32)
+
         # NoData → NaN
         # ① ファイルメタデータのnodata値
         if self.nodata is not None:
@@ -105,7 +140,7 @@ class TerrainLayerGenerator:
             print(f"  海面除去: {_sea_pixels}px を NaN に変換")
 
         # ダウンサンプリング
-        if downsample != 1.0:
+        if downsample != 1.0 and not read_downsampled:
             raw = zoom(raw, downsample, order=1)
 
         # 標高範囲のクリッピング（GUIの段彩設定）
@@ -122,6 +157,10 @@ class TerrainLayerGenerator:
             raw = smoothed
 
         self.elevation = np.ma.masked_invalid(raw)
+        # NaN入りの素の配列と有効マスクは1回だけ作り、以降は参照で使い回す
+        # （等高線抽出・プレビューの各呼び出しでコピーしない）
+        self._data  = self.elevation.data
+        self._valid = ~np.isnan(self._data)
 
         self.min_elev = float(np.nanmin(self.elevation))
         self.max_elev = float(np.nanmax(self.elevation))
@@ -165,6 +204,54 @@ class TerrainLayerGenerator:
     # 等高線抽出
     # ──────────────────────────────────────────
 
+    def _level_mask(self, level):
+        """
+        elevation >= level の領域を穴埋めした uint8 マスクを返す。
+
+        __init__でNaN化・NaN対応スムージング済みなので、NaNとの比較が
+        False になることを利用して有効判定と閾値判定を1回の比較で行う。
+        閉じた低地（周囲が陸で囲まれた海抜以下の窪地）は陸地扱いに埋める。
+        NaN（海）が外部と繋がっている限り海は埋まらないので安全。
+        """
+        data = self._data
+        binary_mask = np.empty(data.shape, dtype=np.uint8)
+        if self._bucket is None:
+            self._build_buckets()
+        k = self._level_index.get(level)
+        if k is not None:
+            np.greater(self._bucket, k, out=binary_mask, casting='unsafe')
+            # 全面が陸なら穴は無いので穴埋めを省く
+            if self._level_count[k] == binary_mask.size:
+                return binary_mask
+        else:
+            np.greater_equal(data, level, out=binary_mask, casting='unsafe')
+        return _fill_holes(binary_mask)
+
+    def _level_pixels(self, level):
+        """elevation >= level の画素数（レベル一覧外の level は None）"""
+        if self._bucket is None:
+            self._build_buckets()
+        k = self._level_index.get(level)
+        return None if k is None else int(self._level_count[k])
+
+    def _build_buckets(self):
+        """
+        全レベルの閾値判定を1パスにまとめる。
+        bucket = (その画素の標高以下にあるレベル数) なので
+        data >= levels[k]  ⇔  bucket > k  （NaN は 0 = どの層にも含まれない）。
+        比較は data と同じ float32 で行い、従来の data >= level と一致させる。
+        """
+        levels = self.get_levels()
+        data = self._data
+        levels_f32 = np.asarray(levels, dtype=np.float32)
+        bucket = np.searchsorted(levels_f32, data, side='right').astype(np.uint16)
+        bucket[~self._valid] = 0
+        # _level_count[k] = bucket > k の画素数（= levels[k] 以上の画素数）
+        hist = np.bincount(bucket.ravel(), minlength=len(levels) + 1)
+        self._level_count = np.cumsum(hist[::-1])[::-1][1:]
+        self._level_index = {lv: k for k, lv in enumerate(levels)}
+        self._bucket = bucket
+
     def extract_contours(self, level, simplify_eps=1.5):
         """
         指定標高レベルに対応する層の輪郭を抽出。
@@ -180,26 +267,16 @@ class TerrainLayerGenerator:
         simplify_eps : float
             簡略化許容誤差（ピクセル）
         """
-        # マスク配列から実データを取得
-        if hasattr(self.elevation, 'data'):
-            data = self.elevation.data.copy()
-            if self.nodata is not None:
-                data[data == self.nodata] = np.nan
-        else:
-            data = self.elevation.copy()
+        # この層に1画素も無ければ（最上層より上など）マスク作成・輪郭追跡を省く
+        if self._level_pixels(level) == 0:
+            return []
 
-        # __init__でNaN対応スムージング済みのため、タイル境界段差は解消済み。
-        # バイナリマスクをそのまま生成する。
-        valid = ~np.isnan(data)
-        binary_mask = valid & (data >= level)
-
-        # 閉じた低地（周囲が陸で囲まれた海抜以下の窪地）を陸地扱いに。
-        # binary_fill_holes は外部と繋がっていない「穴」を埋める。
-        # NaN（海）が外部と繋がっている限り海は埋まらないので安全。
-        binary_mask = binary_fill_holes(binary_mask)
-        padded = np.zeros((binary_mask.shape[0] + 2, binary_mask.shape[1] + 2), dtype=np.float32)
-        padded[1:-1, 1:-1] = binary_mask.astype(np.float32)
+        binary_mask = self._level_mask(level)
+        # uint8 のまま1px パディング（find_contours が内部で float64 化するので
+        # 事前の float32 変換は不要）
+        padded = np.pad(binary_mask, 1)
 
+        from skimage import measure
         raw_contours = measure.find_contours(padded, 0.5)
 
         # パディング分の座標オフセットを除去（-1）
@@ -233,8 +310,6 @@ class TerrainLayerGenerator:
 
         import rasterio
         from PIL import Image
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        import urllib.request
         import math
 
         with rasterio.open(self._src_path) as src:
@@ -253,14 +328,15 @@ class TerrainLayerGenerator:
         nx = x_max - x_min + 1
         ny = y_max - y_min + 1
         TILE = 256
-        mosaic = Image.new('RGB', (nx * TILE, ny * TILE), (240, 240, 240))
+        mosaic = np.full((ny * TILE, nx * TILE, 3), 240, dtype=np.uint8)
+
+        session = _tile_session(12)
 
         def fetch_tile(tx, ty):
             url = (f'https://cyberjapandata.gsi.go.jp/'
                    f'xyz/std/{zoom}/{tx}/{ty}.png')
             try:
-                with urllib.request.urlopen(url, timeout=10) as r:
-                    return tx, ty, Image.open(r).convert('RGB').copy()
+                return tx, ty, _fetch_tile_cached(session, url, 'gsi_std', zoom, tx, ty, timeout=10)
             except Exception:
                 return tx, ty, None
 
@@ -268,15 +344,16 @@ class TerrainLayerGenerator:
                  for ty in range(y_min, y_max + 1)
                  for tx in range(x_min, x_max + 1)]
 
-        with ThreadPoolExecutor(max_workers=12) as pool:
+        # 復号はワーカー側で行い、ここでは numpy モザイクへスライス代入するだけ
+        with session, ThreadPoolExecutor(max_workers=12) as pool:
             futs = {pool.submit(fetch_tile, tx, ty): (tx, ty)
                     for tx, ty in tiles}
             for f in as_completed(futs):
-                tx, ty, img = f.result()
-                if img:
+                tx, ty, tile = f.result()
+                if tile is not None:
                     col = (tx - x_min) * TILE
                     row = (ty - y_min) * TILE
-                    mosaic.paste(img, (col, row))
+                    mosaic[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
 
         # ── タイルモザイクを DEM の正確な地理範囲にクロップ ──────────
         # satellite と同じ理由：タイル境界ずれを補正する
@@ -289,13 +366,10 @@ class TerrainLayerGenerator:
 
         crop_l, crop_t = deg2px_frac_topo(bounds.top,    bounds.left)
         crop_r, crop_b = deg2px_frac_topo(bounds.bottom, bounds.right)
-        mosaic = mosaic.crop((
-            max(0, int(round(crop_l))),
-            max(0, int(round(crop_t))),
-            min(mosaic.width,  int(round(crop_r))),
-            min(mosaic.height, int(round(crop_b))),
-        ))
+        mosaic = mosaic[max(0, int(round(crop_t))):min(mosaic.shape[0], int(round(crop_b))),
+                        max(0, int(round(crop_l))):min(mosaic.shape[1], int(round(crop_r)))]
 
+        mosaic = Image.fromarray(mosaic)
         self._topo_image = mosaic
         return mosaic
 
@@ -318,8 +392,6 @@ class TerrainLayerGenerator:
 
         import rasterio
         from PIL import Image
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        import urllib.request
         import math
 
         with rasterio.open(self._src_path) as src:
@@ -375,18 +447,17 @@ class TerrainLayerGenerator:
         x_max, y_max = deg2num_int(bounds.bottom, bounds.right)
         nx = x_max - x_min + 1
         ny = y_max - y_min + 1
-        mosaic = Image.new('RGB', (nx * TILE, ny * TILE), (30, 30, 30))
+        mosaic = np.full((ny * TILE, nx * TILE, 3), 30, dtype=np.uint8)
+
+        session = _tile_session(12)
+        session.headers['User-Agent'] = 'terrain-layer-generator/1.0 (educational use)'
 
         def fetch_tile(tx, ty):
             # ESRI World Imagery: /{z}/{y}/{x}  (y と x が逆順)
             url = (f'https://server.arcgisonline.com/ArcGIS/rest/services/'
                    f'World_Imagery/MapServer/tile/{zoom}/{ty}/{tx}')
-            req = urllib.request.Request(url, headers={
-                'User-Agent': 'terrain-layer-generator/1.0 (educational use)'
-            })
             try:
-                with urllib.request.urlopen(req, timeout=12) as r:
-                    return tx, ty, Image.open(r).convert('RGB').copy()
+                return tx, ty, _fetch_tile_cached(session, url, 'esri_imagery', zoom, tx, ty, timeout=12)
             except Exception:
                 return tx, ty, None
 
@@ -396,19 +467,24 @@ class TerrainLayerGenerator:
 
         total_tiles = len(tiles)
         done_count  = 0
-        with ThreadPoolExecutor(max_workers=12) as pool:
+        with session, ThreadPoolExecutor(max_workers=12) as pool:
             futs = {pool.submit(fetch_tile, tx, ty): (tx, ty)
                     for tx, ty in tiles}
-            for f in as_completed(futs):
-                tx, ty, img = f.result()
-                if img:
-                    col = (tx - x_min) * TILE
-                    row = (ty - y_min) * TILE
-                    mosaic.paste(img, (col, row))
-                done_count += 1
-                if progress_callback:
-                    progress_callback(done_count, total_tiles,
-                                      f'Satellite tiles: {done_count}/{total_tiles}')
+            try:
+                for f in as_completed(futs):
+                    tx, ty, tile = f.result()
+                    if tile is not None:
+                        col = (tx - x_min) * TILE
+                        row = (ty - y_min) * TILE
+                        mosaic[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+                    done_count += 1
+                    if progress_callback:
+                        progress_callback(done_count, total_tiles,
+                                          f'Satellite tiles: {done_count}/{total_tiles}')
+            except Cancelled:
+                # 未着手のタイル取得は捨てる（実行中の分だけ終わるのを待つ）
+                pool.shutdown(cancel_futures=True)
+                raise
 
         # ── タイルモザイクを DEM の正確な地理範囲にクロップ ──────────
         # タイルはタイル境界から始まるため、モザイクは DEM より広い。
@@ -416,18 +492,30 @@ class TerrainLayerGenerator:
         # 変換し、クロップすることで等高線座標と完全に一致させる。
         crop_l, crop_t = deg2px_frac(bounds.top,    bounds.left)
         crop_r, crop_b = deg2px_frac(bounds.bottom, bounds.right)
-        crop_box = (
-            max(0, int(round(crop_l))),
-            max(0, int(round(crop_t))),
-            min(mosaic.width,  int(round(crop_r))),
-            min(mosaic.height, int(round(crop_b))),
-        )
-        mosaic = mosaic.crop(crop_box)
+        mosaic = mosaic[max(0, int(round(crop_t))):min(mosaic.shape[0], int(round(crop_b))),
+                        max(0, int(round(crop_l))):min(mosaic.shape[1], int(round(crop_r)))]
 
+        mosaic = Image.fromarray(mosaic)
         self._satellite_image = mosaic
         return mosaic
 
 
+    def _raster_href(self, colormap, out_dir):
+        """
+        背景タイル画像を out_dir/background_{colormap}.png に1回だけ書き出し、
+        SVGから参照する相対パスを返す（全レイヤーで同じ画像を共有する）
+        """
+        key = (colormap, str(out_dir))
+        href = self._raster_hrefs.get(key)
+        if href is None:
+            img = (self._ensure_satellite_image() if colormap == 'satellite'
+                   else self._ensure_topo_image())
+            href = f'background_{colormap}.png'
+            # 1回きりの書き出しなので圧縮率より速度を優先（zlib レベル1）
+            img.save(Path(out_dir) / href, format='PNG', compress_level=1)
+            self._raster_hrefs[key] = href
+        return href
+
     # ──────────────────────────────────────────
     # SVG 生成
     # ──────────────────────────────────────────
@@ -469,7 +557,7 @@ class TerrainLayerGenerator:
             svg_h, svg_w = h, w
             coord_sx = coord_sy = 1.0
 
-        dwg = svgwrite.Drawing(
+        dwg = _SvgDrawing(
             str(output_path),
             size=(f'{svg_w * scale}mm', f'{svg_h * scale}mm'),
             viewBox=f'0 0 {svg_w} {svg_h}',
@@ -479,74 +567,40 @@ class TerrainLayerGenerator:
         # ── 背景 ─────────────────────────────────────────────────────
         is_base_layer = (level <= max(0.0, self.base_elev) + 0.01)
         bg_color = '#40cbc8' if is_base_layer else 'white'
+        if is_base_layer and colormap == 'satellite':
+            bg_color = '#0a143c'
         dwg.add(dwg.rect(insert=(0, 0), size=(svg_w, svg_h), fill=bg_color))
 
-        # ── gsi_topo / satellite モード：実写タイル画像をPILで事前マスク合成して埋め込む ──
+        # ── gsi_topo / satellite モード：実写タイル画像を層の輪郭でクリップして埋め込む ──
+        # 画像は全層共通のPNGとして1回だけ書き出して相対参照し、層ごとの違いは
+        # 輪郭ポリゴンの clipPath で表現する（層ごとのマスク合成・PNGエンコード不要）
         if colormap in ('gsi_topo', 'satellite'):
-            import base64, io
-            from PIL import Image as PILImage
-            topo_img = (self._ensure_satellite_image() if colormap == 'satellite'
-                        else self._ensure_topo_image())  # tile mosaic
-            tw, th = topo_img.size  # タイル合成後のオリジナル解像度
-
-            # DEMマスク（ダウンサンプル済みh×w）をtopo解像度に拡大して合成
-            if hasattr(self.elevation, 'data'):
-                _data = self.elevation.data.copy()
-            else:
-                _data = self.elevation.copy()
-            valid_mask = ~np.isnan(_data)
-            binary_mask = (valid_mask & (_data >= level)).astype(np.uint8)
-            binary_mask = binary_fill_holes(binary_mask).astype(np.uint8)
-
-            if next_next_level is not None:
-                nn_mask = (valid_mask & (_data >= next_next_level)).astype(np.uint8)
-            else:
-                nn_mask = None
-
-            # マスクをtopo解像度に拡大（NEAREST = シャープなエッジ）
-            mask_img = PILImage.fromarray(binary_mask * 255, mode='L')
-            mask_img = mask_img.resize((tw, th), PILImage.NEAREST)
-
-            # 白背景キャンバス（orig_shape解像度）に地形図を合成
-            if colormap == 'satellite':
-                bg_color_rgb = (10, 20, 60) if is_base_layer else (255, 255, 255)
-            else:
-                bg_color_rgb = (64, 203, 200) if is_base_layer else (255, 255, 255)
-            canvas = PILImage.new('RGB', (tw, th), bg_color_rgb)
-            canvas.paste(topo_img, mask=mask_img)
-
-            # nn_mask領域をグレー上塗り
-            if nn_mask is not None:
-                nn_mask_img = PILImage.fromarray(nn_mask * 255, mode='L')
-                nn_mask_img = nn_mask_img.resize((tw, th), PILImage.NEAREST)
-                grey = PILImage.new('RGB', (tw, th), (240, 240, 240))
-                canvas.paste(grey, mask=nn_mask_img)
-
-            # base64に変換してSVGに埋め込む
-            buf = io.BytesIO()
-            canvas.save(buf, format='PNG')
-            b64 = base64.b64encode(buf.getvalue()).decode()
-
-            dwg.add(dwg.image(
-                href=f'data:image/png;base64,{b64}',
-                insert=(0, 0),
-                size=(svg_w, svg_h),
-            ))
-
-            # 輪郭線（黒細線）と赤破線
             # 輪郭座標はDEM解像度なのでsvg_w/svg_h比率でスケールアップ
-            def contours_to_paths(contour_list, fill, stroke, sw, extra=None):
+            def contours_to_paths(contour_list, fill, stroke, sw, extra=None, parent=dwg):
                 for c in contour_list:
-                    pts = [(float(col) * coord_sx, float(row) * coord_sy)
-                           for row, col in c]
-                    if len(pts) < 3:
+                    if len(c) < 3:
                         continue
-                    d = 'M ' + ' L '.join(f'{x:.2f},{y:.2f}' for x, y in pts) + ' Z'
+                    d = _path_d(c, coord_sx, coord_sy)
                     kw = dict(d=d, fill=fill, stroke=stroke, stroke_width=sw)
                     if extra:
                         kw.update(extra)
-                    dwg.add(dwg.path(**kw))
+                    parent.add(dwg.path(**kw))
+
+            clip = dwg.defs.add(dwg.clipPath(id='layer_clip'))
+            contours_to_paths(contours, 'black', 'none', 0, parent=clip)
+            # clip-path は <g> 側に付ける（svglib は <image> 直付けのクリップを扱えない）
+            clipped = dwg.add(dwg.g(clip_path='url(#layer_clip)'))
+            clipped.add(dwg.image(
+                href=self._raster_href(colormap, Path(output_path).parent),
+                insert=(0, 0),
+                size=(svg_w, svg_h),
+            ))
+
+            # 2レイヤー上の領域をグレー上塗り（インク削減）
+            if next_next_level is not None:
+                contours_to_paths(_get_contours(next_next_level), '#f0f0f0', 'none', 0)
 
+            # 輪郭線（黒細線）と赤破線
             contours_to_paths(contours, 'none', 'black', stroke_width)
 
             if next_level is not None:
@@ -561,6 +615,7 @@ class TerrainLayerGenerator:
 
         # ── 段彩色を計算 ─────────────────────────────────────────────
         import matplotlib.pyplot as plt
+        _register_topo_cmap()
         cmap = plt.get_cmap(colormap)
         # terrain cmapは1.0付近が白になるため上限をクランプ。
         # topo / その他は全域を使う。
@@ -573,10 +628,9 @@ class TerrainLayerGenerator:
 
         def contours_to_paths(contour_list, fill, stroke, sw, extra=None):
             for c in contour_list:
-                pts = [(float(col), float(row)) for row, col in c]
-                if len(pts) < 3:
+                if len(c) < 3:
                     continue
-                d = 'M ' + ' L '.join(f'{x:.2f},{y:.2f}' for x, y in pts) + ' Z'
+                d = _path_d(c)
                 kw = dict(d=d, fill=fill, stroke=stroke, stroke_width=sw)
                 if extra:
                     kw.update(extra)
@@ -624,28 +678,49 @@ class TerrainLayerGenerator:
         # ── 全レベルの輪郭を事前一括計算（キャッシュ） ─────────────────
         print("輪郭を事前計算中...")
         t_pre = time.time()
+        # 各レベルは独立なのでスレッドで並列計算する（穴埋め・輪郭追跡の
+        # ネイティブ処理はGILを離すため複数コアを使える）。
+        # レベル分けの前計算は先に1回だけ済ませておく
+        if self._bucket is None:
+            self._build_buckets()
         contour_cache = {}
-        for idx, lv in enumerate(tqdm(levels, desc='輪郭計算', unit='層'), 1):
-            contour_cache[lv] = self.extract_contours(lv, simplify_eps)
-            if progress_callback:
-                progress_callback(idx, total, 'contour')
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+            futs = {pool.submit(self.extract_contours, lv, simplify_eps): lv
+                    for lv in levels}
+            for idx, f in enumerate(tqdm(as_completed(futs), total=total,
+                                         desc='輪郭計算', unit='層'), 1):
+                contour_cache[futs[f]] = f.result()
+                if progress_callback:
+                    progress_callback(idx, total, 'contour')
         print(f"  事前計算完了: {time.time() - t_pre:.1f}秒")
 
         t = time.time()
         ok_count = 0
 
-        for i, level in enumerate(tqdm(levels, desc='SVG生成', unit='層'), 1):
-            path = out / f'layer_{i:04d}_{int(level)}m.svg'
-            next_level      = levels[i]     if i     < len(levels) else None
-            next_next_level = levels[i + 1] if i + 1 < len(levels) else None
-            if self.generate_svg(level, path, scale=scale, simplify_eps=simplify_eps,
-                                 colormap=colormap,
-                                 next_level=next_level,
-                                 next_next_level=next_next_level,
-                                 contour_cache=contour_cache):
-                ok_count += 1
-            if progress_callback:
-                progress_callback(i, total, 'svg')
+        # 背景タイル画像はスレッドごとに取得・エンコードしないよう先に1回だけ用意する
+        if colormap in ('gsi_topo', 'satellite'):
+            self._raster_href(colormap, out)
+
+        # 各レイヤーは別ファイルへ書くだけなので独立に並列生成できる
+        # （PNGエンコード・ファイル書き込みはGILを離す）
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 4)) as pool:
+            futs = []
+            for i, level in enumerate(levels, 1):
+                path = out / f'layer_{i:04d}_{int(level)}m.svg'
+                next_level      = levels[i]     if i     < len(levels) else None
+                next_next_level = levels[i + 1] if i + 1 < len(levels) else None
+                futs.append(pool.submit(self.generate_svg, level, path, scale=scale,
+                                        simplify_eps=simplify_eps,
+                                        colormap=colormap,
+                                        next_level=next_level,
+                                        next_next_level=next_next_level,
+                                        contour_cache=contour_cache))
+            for i, f in enumerate(tqdm(as_completed(futs), total=total,
+                                       desc='SVG生成', unit='層'), 1):
+                if f.result():
+                    ok_count += 1
+                if progress_callback:
+                    progress_callback(i, total, 'svg')
 
         elapsed = time.time() - t
         print(f"\n✅ {ok_count}/{total}層を生成  ({elapsed:.1f}秒)")
@@ -704,12 +779,10 @@ class TerrainLayerGenerator:
         matplotlib.use('Agg')
         import matplotlib.pyplot as plt
         import matplotlib.colors as mcolors
+        _register_topo_cmap()
 
-        # -9999をNaNに変換してマスク配列を作成
-        data = self.elevation.data.copy()
-        if self.nodata is not None:
-            data[data == self.nodata] = np.nan
-        data = np.ma.masked_invalid(data)
+        # __init__でnodata→NaN化済みのマスク配列をそのまま使う
+        data = self.elevation
 
         # gsi_topo / satellite モード：実写タイル画像をプレビューに使う
         if colormap in ('gsi_topo', 'satellite'):
@@ -721,7 +794,7 @@ class TerrainLayerGenerator:
                 tw, th = topo_img.size
 
                 # nan_mask（elevation解像度）をtopo解像度に拡大
-                nan_mask_small = np.isnan(self.elevation.data)
+                nan_mask_small = ~self._valid
                 nan_mask_img = _PILImage.fromarray(nan_mask_small.astype(np.uint8) * 255, mode='L')
                 nan_mask_img = nan_mask_img.resize((tw, th), _PILImage.NEAREST)
                 nan_mask = np.array(nan_mask_img) > 128
@@ -741,6 +814,8 @@ class TerrainLayerGenerator:
                 plt.savefig(output_file, dpi=150, bbox_inches='tight')
                 plt.close(fig)
                 return
+            except Cancelled:
+                raise
             except Exception as e:
                 import traceback
                 print(f"gsi_topo プレビューエラー: {e}")
@@ -765,7 +840,12 @@ class TerrainLayerGenerator:
         valid = data.compressed()
         vmin, vmax = np.percentile(valid, 2), np.percentile(valid, 98)
 
-        im = ax.imshow(data, cmap=cmap, aspect='equal', vmin=vmin, vmax=vmax)
+        # 出力（10x7in @150dpi）より十分大きい DEM は先にブロック平均で縮小してから描く
+        # （matplotlib に全画素を渡すと縮小描画だけで数秒かかる）
+        f = int(min(data.shape[0] / 1050, data.shape[1] / 1500))
+        shown = _block_mean(self._data, f) if f >= 2 else data
+
+        im = ax.imshow(shown, cmap=cmap, aspect='equal', vmin=vmin, vmax=vmax)
         plt.colorbar(im, ax=ax, label='Elevation (m)')
         ax.set_title(f'Elevation  {np.min(valid):.1f}m - {np.max(valid):.1f}m')
         ax.axis('off')
@@ -779,32 +859,242 @@ class TerrainLayerGenerator:
 # ──────────────────────────────────────────────
 
 # ──────────────────────────────────────────────
-# RDP 簡略化（外部ライブラリ不要）
+# 背景タイルのディスクキャッシュ
 # ──────────────────────────────────────────────
 
-def _rdp_simplify(points, epsilon):
-    """Ramer–Douglas–Peucker アルゴリズム"""
-    if len(points) < 3:
-        return points
+TILE_CACHE_DIR = Path.home() / '.cache' / 'terrain_layering' / 'tiles'
+
+
+def _fetch_tile_cached(session, url, provider, z, x, y, timeout=10):
+    """
+    背景タイルを RGB の uint8 配列で返す（取得・復号の失敗は None）。
+    TILE_CACHE_DIR/{provider}/{z}/{x}/{y} にあればネットワークに出ない。
+    復号できたものだけを保存し（HTMLのエラーページや途中で切れた応答を残さない）、
+    キャッシュが復号できなければ削除して取り直す。
+    書き込みは一時ファイル → rename で行い、途中で落ちても壊れたタイルを残さない。
+    """
+    from PIL import Image
+    from io import BytesIO
+
+    def decode(data):
+        return np.asarray(Image.open(BytesIO(data)).convert('RGB'))
+
+    cache = TILE_CACHE_DIR / provider / str(z) / str(x) / str(y)
+    try:
+        return decode(cache.read_bytes())
+    except OSError:
+        pass
+    except Exception:
+        try:
+            cache.unlink()
+        except OSError:
+            pass
+
+    r = session.get(url, timeout=timeout)
+    if r.status_code != 200:
+        return None
+    try:
+        tile = decode(r.content)
+    except Exception:
+        return None
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache.with_name(f'{y}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp.write_bytes(r.content)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+    return tile
+
+
+# ──────────────────────────────────────────────
+# SVG 書き出し（svgwrite 互換の軽量版）
+# ──────────────────────────────────────────────
+
+def _svg_attrs(attrs):
+    """svgwrite と同じ規則（_→-、名前順、XMLエスケープ）で属性文字列を作る"""
+    items = sorted((k.rstrip('_').replace('_', '-'), v) for k, v in attrs.items())
+    return ''.join(f' {k}="{escape(str(v), {chr(34): "&quot;"})}"' for k, v in items)
+
+
+def _svg_element(tag, insert=None, size=None, href=None, **attrs):
+    if insert is not None:
+        attrs['x'], attrs['y'] = insert
+    if size is not None:
+        attrs['width'], attrs['height'] = size
+    if href is not None:
+        attrs['xlink:href'] = href
+    return f'<{tag}{_svg_attrs(attrs)} />'
+
+
+class _SvgGroup:
+    """子要素を持つ要素（defs / g / clipPath）"""
+
+    def __init__(self, tag, **attrs):
+        self.tag      = tag
+        self.attrs    = attrs
+        self.children = []
+
+    def add(self, element):
+        self.children.append(element)
+        return element
+
+    def __str__(self):
+        if not self.children:
+            return f'<{self.tag}{_svg_attrs(self.attrs)} />'
+        body = ''.join(map(str, self.children))
+        return f'<{self.tag}{_svg_attrs(self.attrs)}>{body}</{self.tag}>'
+
+
+class _SvgDrawing(_SvgGroup):
+    """
+    generate_svg が使う svgwrite.Drawing の機能だけを文字列連結で実装したもの。
+    要素ごとのオブジェクト構築・検証・ElementTree 直列化を省き、
+    出力は svgwrite と同一のバイト列になる。
+    """
+
+    def __init__(self, filename, size, viewBox, profile='full'):
+        super().__init__('svg', baseProfile=profile, width=size[0], height=size[1],
+                         version='1.1', viewBox=viewBox,
+                         xmlns='http://www.w3.org/2000/svg',
+                         **{'xmlns:ev': 'http://www.w3.org/2001/xml-events',
+                            'xmlns:xlink': 'http://www.w3.org/1999/xlink'})
+        self.filename = filename
+        self.defs = self.add(_SvgGroup('defs'))
+
+    def path(self, **attrs):
+        return _svg_element('path', **attrs)
+
+    def rect(self, **attrs):
+        return _svg_element('rect', **attrs)
+
+    def image(self, **attrs):
+        return _svg_element('image', **attrs)
+
+    def g(self, **attrs):
+        return _SvgGroup('g', **attrs)
 
-    # 最遠点を探す
-    start, end = points[0], points[-1]
-    d = end - start
-    norm = np.linalg.norm(d)
+    def clipPath(self, **attrs):
+        return _SvgGroup('clipPath', **attrs)
 
-    if norm == 0:
-        dists = np.linalg.norm(points - start, axis=1)
-    else:
-        dists = np.abs(np.cross(d, start - points)) / norm
+    def save(self):
+        with open(self.filename, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+            f.write(str(self))
 
-    idx = np.argmax(dists)
 
-    if dists[idx] > epsilon:
-        left  = _rdp_simplify(points[:idx + 1], epsilon)
-        right = _rdp_simplify(points[idx:],     epsilon)
-        return np.vstack([left[:-1], right])
-    else:
-        return np.vstack([start, end])
+# ──────────────────────────────────────────────
+# SVG パス文字列
+# ──────────────────────────────────────────────
+
+def _path_d(contour, sx=1.0, sy=1.0):
+    """
+    (row, col) 輪郭を閉じたSVGパス 'M x,y L x,y ... Z' に変換する。
+    座標変換は配列演算でまとめて行い、書式化も頂点数分の '%.2f,%.2f' を
+    連結した書式文字列に1回の % で流し込む（頂点ごとの f-string を作らない）。
+    """
+    xy = np.empty((len(contour), 2), dtype=np.float64)
+    np.multiply(contour[:, 1], sx, out=xy[:, 0])
+    np.multiply(contour[:, 0], sy, out=xy[:, 1])
+    fmt = 'M ' + ' L '.join(['%.2f,%.2f'] * len(xy)) + ' Z'
+    return fmt % tuple(xy.ravel().tolist())
+
+
+# ──────────────────────────────────────────────
+# タイル取得用 HTTP セッション
+# ──────────────────────────────────────────────
+
+def _tile_session(pool_size):
+    """
+    背景タイル取得用の requests.Session。
+    ワーカー全体で keep-alive 接続を共有し、TLSハンドシェイクをタイルごとに
+    繰り返さない（プールはワーカー数に合わせる）。
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# ──────────────────────────────────────────────
+# 穴埋め
+# ──────────────────────────────────────────────
+
+def _block_mean(a, f):
+    """f×f ブロックごとの NaN を除いた平均（全て NaN のブロックは NaN）"""
+    ph, pw = -a.shape[0] % f, -a.shape[1] % f
+    if ph or pw:
+        a = np.pad(a, ((0, ph), (0, pw)), constant_values=np.nan)
+    blocks = a.reshape(a.shape[0] // f, f, a.shape[1] // f, f)
+    valid = ~np.isnan(blocks)
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    count = valid.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total / count).astype(np.float32)
+
+
+def _fill_holes(mask):
+    """外部と繋がっていない穴を埋める（fill_voids があればそちらを使う）"""
+    if fill_voids is not None:
+        return fill_voids.fill(mask, in_place=True)
+    from scipy.ndimage import binary_fill_holes
+    return binary_fill_holes(mask).astype(np.uint8)
+
+
+# ──────────────────────────────────────────────
+# RDP 簡略化（外部ライブラリ不要）
+# ──────────────────────────────────────────────
+
+def _rdp_simplify(points, epsilon):
+    """
+    Ramer–Douglas–Peucker アルゴリズム
+
+    再帰と vstack の代わりに (lo, hi) の区間スタックと keep フラグで
+    反復処理する（長い輪郭でも再帰が深くならず、中間配列も作らない）。
+    """
+    n = len(points)
+    if n < 3:
+        return points
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        lo, hi = stack.pop()
+        if hi - lo < 2:
+            continue
+        # 端点はPythonのfloatで取り出す（NumPyスカラー演算のオーバーヘッドを避ける）
+        ax, ay = points[lo].tolist()
+        bx, by = points[hi].tolist()
+        seg = points[lo + 1:hi]
+        dx = bx - ax
+        dy = by - ay
+        norm = math.hypot(dx, dy)
+        if norm == 0:
+            # 閉じた輪郭の始点=終点: 始点からの距離。最遠点は二乗距離で探し、
+            # 平方根はその1点だけ取る
+            ex = seg[:, 0] - ax
+            ey = seg[:, 1] - ay
+            sq = ex * ex + ey * ey
+            idx = int(np.argmax(sq))
+            far = math.sqrt(sq[idx])
+        else:
+            # 2Dの外積 |d × (a - p)| / |d| = 直線までの距離
+            dists = dx * (ay - seg[:, 1])
+            dists -= dy * (ax - seg[:, 0])
+            np.abs(dists, out=dists)
+            idx = int(np.argmax(dists))
+            far = dists[idx] / norm
+        if far > epsilon:
+            mid = lo + 1 + idx
+            keep[mid] = True
+            stack.append((mid, hi))
+            stack.append((lo, mid))
+
+    return points[keep]
 
 
 # ──────────────────────────────────────────────
@@ -8,11 +8,9 @@ Flask内蔵による地図選択機能付き
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from tkinter import scrolledtext
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
 import threading
+import collections
+import functools
 from pathlib import Path
 import sys
 import os
@@ -35,19 +33,126 @@ def get_resource_dir() -> Path:
         return Path(sys._MEIPASS)
     return Path(__file__).parent
 
-# terrain_layering.pyをインポート
+# terrain_layering.py は numpy などを読み込むので、起動を速くするため使う時点で import する
 sys.path.insert(0, str(get_base_dir()))
-from terrain_layering import TerrainLayerGenerator
 
 # Flask（地図選択機能用）
-try:
-    from flask import Flask, render_template, request, jsonify
-    FLASK_AVAILABLE = True
-except ImportError:
-    FLASK_AVAILABLE = False
+# 起動を重くしないよう、有無だけ確認して import は地図サーバー起動時に行う
+import importlib.util
+FLASK_AVAILABLE = importlib.util.find_spec('flask') is not None
 
 MAP_SERVER_PORT = 5001
 
+
+@functools.lru_cache(maxsize=32)
+def _probe_dem(path, mtime):
+    """GeoTIFFのヘッダーだけ読んで (bounds, width, height) を返す（パス+更新時刻でキャッシュ）"""
+    import rasterio
+    with rasterio.open(path) as src:
+        return tuple(src.bounds), src.width, src.height
+
+
+@functools.lru_cache(maxsize=None)
+def _register_jp_font():
+    """日本語TTFを探して ReportLab に 'JPFont' として登録し、そのフォント名を返す。
+    見つからなければ None。巨大な .ttc の解析は重いので結果はプロセス内でキャッシュする。"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    if _sys == 'Windows':
+        candidates = [
+            r'C:\Windows\Fonts\msgothic.ttc',
+            r'C:\Windows\Fonts\meiryo.ttc',
+            r'C:\Windows\Fonts\YuGothM.ttc',
+        ]
+    elif _sys == 'Darwin':
+        candidates = [
+            '/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc',
+            '/Library/Fonts/Osaka.ttf',
+        ]
+    else:
+        candidates = [
+            '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+            '/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc',
+        ]
+    for fp in candidates:
+        if not os.path.exists(fp):
+            continue
+        try:
+            # ttcの場合はサブフォント0番を使用
+            pdfmetrics.registerFont(TTFont('JPFont', fp, subfontIndex=0))
+            return 'JPFont'
+        except Exception:
+            try:
+                pdfmetrics.registerFont(TTFont('JPFont', fp))
+                return 'JPFont'
+            except Exception:
+                pass
+    return None
+
+
+def _list_layer_svgs(output_dir):
+    """output_dir 内の layer_*.svg を名前順で返す（無ければ空リスト）。
+    os.scandir の DirEntry で名前だけを見て絞り込むので、レイヤーが多くても速い。"""
+    try:
+        with os.scandir(output_dir) as it:
+            names = sorted(e.name for e in it
+                           if e.name.startswith('layer_') and e.name.endswith('.svg')
+                           and e.is_file())
+    except OSError:
+        return []
+    output_dir = Path(output_dir)
+    return [output_dir / name for name in names]
+
+
+def _draw_layer(drawing, c, x, y):
+    """renderPDF.draw と同じだが、ラスタ画像はインライン画像ではなく XObject として描く。
+    地理院地図・衛星写真モードでは全レイヤーが同じ背景画像を参照するので、
+    PDF には1度だけ格納され、2ページ目以降の（純Pythonの）エンコードも省ける。
+    見つからなかった画像ファイルのパスをリストで返す。"""
+    from reportlab.graphics import renderPDF
+    from reportlab.graphics.renderbase import renderScaledDrawing
+    from reportlab.lib.utils import ImageReader
+
+    missing = []
+
+    class _Renderer(renderPDF._PDFRenderer):
+        def drawImage(self, image):
+            path = image.path   # ファイルパス、または埋め込み画像なら PIL Image
+            if hasattr(path, 'mode'):
+                path = ImageReader(path)
+            elif not (path and os.path.exists(path)):
+                missing.append(path)
+                return
+            self._canvas.drawImage(path, image.x, image.y, image.width, image.height)
+
+    _Renderer().draw(renderScaledDrawing(drawing), c, x, y)
+    return missing
+
+
+def _svg_to_drawing(path):
+    """SVG → ReportLab Drawing（PDF生成のワーカープロセスで実行）。
+    失敗は例外ではなく (None, メッセージ) で返し、他のページの変換を止めない。"""
+    try:
+        from svglib.svglib import svg2rlg
+        return svg2rlg(path), None
+    except Exception as e:
+        return None, str(e)
+
+
+# 解析済み Drawing のプロセス内キャッシュ（同じセッションで PDF を作り直すとき svglib の解析を省く）。
+# svglib は画像の href をカレントディレクトリ基準のパスで持つので、キーには cwd も含める。
+# 描画時に Drawing を書き換えるため、値は pickle したバイト列で持ち、使うたびに復元する。
+_drawing_cache = {}
+
+
+def _drawing_cache_key(svg):
+    try:
+        st = os.stat(svg)
+    except OSError:
+        return None
+    return os.path.abspath(svg), os.getcwd(), st.st_mtime_ns, st.st_size
+
 # ── クロスプラットフォーム対応フォント選択 ────────────────────────────────
 import platform as _platform
 _sys = _platform.system()
@@ -135,14 +240,26 @@ class TerrainLayerGUI:
         # 変数の初期化
         self.dem_file = None
         self.dem_pixel_m = None   # GeoTIFF 1ピクセルあたりの実距離(m)
+        self._scale_cache_key = None   # 縮尺表示を最後に計算したときの入力
         self.generator = None
         self.preview_image = None
+        self._preview_key = None   # preview_image を作ったときの入力（DEM+パラメータ）
+        self._preview_after_id = None
+        self._preview_cancel = None   # 実行中のプレビューを打ち切るための threading.Event
 
         # 設定ファイル（スクリプトと同じディレクトリ）
         self._config_path = get_base_dir() / 'terrain_gui_config.json'
+        self._last_saved_cfg = None   # 最後に書き出した設定（変化が無ければ書き込まない）
+
+        # ログはキューに溜めてメインループのタイマーでまとめて表示する
+        # （ワーカースレッドから Tk を直接触らない・行ごとに update() しない）
+        self._log_queue = collections.deque()
+        # 進捗バーも同じタイマーで反映する。最新の (割合, 表示文字列) だけ残れば十分
+        self._progress_latest = collections.deque(maxlen=1)
 
         # UIの構築
         self.create_widgets()
+        self.root.after(50, self._flush_log)
 
         # 設定を復元（UI構築後）
         self._load_settings()
@@ -204,9 +321,14 @@ class TerrainLayerGUI:
             'paper_size': self.paper_size_var.get(),
             'scale':      self.scale_var.get(),
         }
+        if cfg == self._last_saved_cfg:
+            return
         try:
-            self._config_path.write_text(
-                json.dumps(cfg, ensure_ascii=False, indent=2), encoding='utf-8')
+            # 一時ファイルに書いてから置き換える（書き込み途中で落ちても設定が壊れない）
+            tmp = self._config_path.with_suffix('.json.tmp')
+            tmp.write_text(json.dumps(cfg, ensure_ascii=False, indent=2), encoding='utf-8')
+            os.replace(tmp, self._config_path)
+            self._last_saved_cfg = cfg
         except Exception:
             pass
 
@@ -259,6 +381,7 @@ class TerrainLayerGUI:
             webbrowser.open(f'http://localhost:{MAP_SERVER_PORT}')
             return
 
+        from flask import Flask, render_template, request, jsonify, send_from_directory
         try:
             from download_dem import create_geotiff
         except ImportError:
@@ -300,8 +423,8 @@ class TerrainLayerGUI:
 
         @flask_app.route('/')
         def index():
-            html_path = get_resource_dir() / 'templates' / 'map_viewer.html'
-            return html_path.read_text(encoding='utf-8')
+            # send_from_directory なら Last-Modified/ETag 付きで返し、再読み込みは 304 で済む
+            return send_from_directory(str(template_dir), 'map_viewer.html', max_age=60)
 
         @flask_app.route('/api/download_dem', methods=['POST'])
         def api_download_dem():
@@ -378,9 +501,15 @@ class TerrainLayerGUI:
         t.start()
         self._flask_running = True
 
-        # 起動を少し待ってからブラウザを開く
+        # サーバーが接続を受け付けるようになったらブラウザを開く（最大2.5秒待つ）
         def _open_browser():
-            import time; time.sleep(0.8)
+            import socket, time
+            for _ in range(50):
+                try:
+                    with socket.create_connection(('127.0.0.1', MAP_SERVER_PORT), timeout=0.1):
+                        break
+                except OSError:
+                    time.sleep(0.05)
             webbrowser.open(f'http://localhost:{MAP_SERVER_PORT}')
         threading.Thread(target=_open_browser, daemon=True).start()
         self.log(f"地図サーバー起動: http://localhost:{MAP_SERVER_PORT}")
@@ -396,6 +525,7 @@ class TerrainLayerGUI:
         self._save_settings()
         self._load_dem_pixel_m(filepath)
         try:
+            from terrain_layering import TerrainLayerGenerator
             gen = TerrainLayerGenerator(filepath)
             self.log(f"標高範囲: {gen.min_elev:.0f}m ～ {gen.max_elev:.0f}m")
             self.log(f"レイヤー数: {len(gen.get_levels())}層（間隔 {int(self.interval_var.get())}m）")
@@ -404,7 +534,7 @@ class TerrainLayerGUI:
 
         self.log(f"プレビューを自動生成中...")
         # プレビューを自動起動
-        self.update_preview()
+        self.schedule_preview()
         
     def create_control_panel(self, parent):
         # canvas+scrollbar を1つのFrameに収めることで
@@ -468,7 +598,7 @@ class TerrainLayerGUI:
 
         # interval変更時に自動再計算（scale_var/paper_size_varは後で定義されるため
         # trace登録はcreate_control_panel末尾で行う）
-        self.interval_var.trace_add('write', lambda *_: self._update_scale_info())
+        self.interval_var.trace_add('write', lambda *_: self._schedule_scale_update())
 
         # === 3. 段彩設定 ===
         color_frame = ttk.LabelFrame(scrollable_frame, text="3. 段彩設定", padding=6)
@@ -541,7 +671,7 @@ class TerrainLayerGUI:
         button_frame.pack(fill=tk.X, padx=PX, pady=(6, 2))
 
         ttk.Button(button_frame, text="プレビュー更新",
-                   command=self.update_preview,
+                   command=self.schedule_preview,
                    style="Action.TButton").pack(fill=tk.X, pady=1)
         ttk.Button(button_frame, text="SVGファイル生成",
                    command=self.generate_layers,
@@ -574,8 +704,8 @@ class TerrainLayerGUI:
         self.progress_text.pack(fill=tk.BOTH, expand=True)
 
         # scale_var / paper_size_var は出力設定セクションで定義済みなのでここで登録
-        self.scale_var.trace_add('write',     lambda *_: self._update_scale_info())
-        self.paper_size_var.trace_add('write', lambda *_: self._update_scale_info())
+        self.scale_var.trace_add('write',     lambda *_: self._schedule_scale_update())
+        self.paper_size_var.trace_add('write', lambda *_: self._schedule_scale_update())
         
     def create_preview_panel(self, parent):
         # 外枠フレーム（bd=0で余白なし）
@@ -603,22 +733,32 @@ class TerrainLayerGUI:
         self._placeholder.place(relx=0.5, rely=0.5, anchor='center')
 
         # Matplotlibの図（初期は非表示、プレビュー生成時に表示）
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
         self.fig = Figure(dpi=100)
         self.ax = self.fig.add_subplot(111)
+        self._preview_artist = None   # プレビュー画像の AxesImage（初回表示で作成）
         self.canvas = FigureCanvasTkAgg(self.fig, master=preview_frame)
         # canvas は最初 pack しない → placeholder が見える
         self._canvas_packed = False
         self._preview_frame = preview_frame
 
+        self._resize_job = None
+
+        def _redraw_preview(w, h):
+            self._resize_job = None
+            self.fig.set_size_inches(max(w / self.fig.dpi, 1), max(h / self.fig.dpi, 1))
+            self.canvas.draw_idle()
+
         def _on_preview_resize(e):
             # プレースホルダーを中央に追従
             self._placeholder.place(relx=0.5, rely=0.5, anchor='center')
             # canvas表示中ならfigureサイズも更新して再描画
+            # （ドラッグ中は連続で来るので、止まってから80ms後に1回だけ描く）
             if self._canvas_packed and self.preview_image is not None:
-                w_in = max(e.width  / self.fig.dpi, 1)
-                h_in = max(e.height / self.fig.dpi, 1)
-                self.fig.set_size_inches(w_in, h_in)
-                self.canvas.draw_idle()
+                if self._resize_job is not None:
+                    self.root.after_cancel(self._resize_job)
+                self._resize_job = self.root.after(80, _redraw_preview, e.width, e.height)
 
         preview_frame.bind('<Configure>', _on_preview_resize)
         
@@ -637,18 +777,30 @@ class TerrainLayerGUI:
             pass
     
     def _load_dem_pixel_m(self, filepath):
-        """GeoTIFFのピクセルあたり実距離(m)とピクセル数をキャッシュ"""
+        """GeoTIFFのピクセルあたり実距離(m)とピクセル数をキャッシュ
+        （ヘッダー読み込みはワーカースレッドで行い、結果だけメインループに戻す）"""
+        def probe():
+            try:
+                info = _probe_dem(str(filepath), os.path.getmtime(filepath))
+            except Exception:
+                info = None
+            self.root.after(0, lambda: self._apply_dem_pixel_m(info))
+
+        threading.Thread(target=probe, daemon=True).start()
+
+    def _apply_dem_pixel_m(self, info):
         try:
-            import rasterio, math
-            with rasterio.open(filepath) as src:
-                bounds = src.bounds
-                self.dem_pixel_w = src.width
-                self.dem_pixel_h = src.height
-            lat_c = (bounds.top + bounds.bottom) / 2
-            deg_per_px_lat = (bounds.top  - bounds.bottom) / self.dem_pixel_h
-            deg_per_px_lon = (bounds.right - bounds.left)  / self.dem_pixel_w
-            m_per_deg_lat = 111320.0
-            m_per_deg_lon = 111320.0 * math.cos(math.radians(lat_c))
+            import math
+            (left, bottom, right, top), self.dem_pixel_w, self.dem_pixel_h = info
+            lat_c = (top + bottom) / 2
+            deg_per_px_lat = (top  - bottom) / self.dem_pixel_h
+            deg_per_px_lon = (right - left)  / self.dem_pixel_w
+            # WGS84 楕円体での緯度1度・経度1度の長さ（級数展開、cm 精度）
+            phi = math.radians(lat_c)
+            m_per_deg_lat = (111132.92 - 559.82 * math.cos(2 * phi)
+                             + 1.175 * math.cos(4 * phi) - 0.0023 * math.cos(6 * phi))
+            m_per_deg_lon = (111412.84 * math.cos(phi) - 93.5 * math.cos(3 * phi)
+                             + 0.118 * math.cos(5 * phi))
             self.dem_pixel_m = (
                 deg_per_px_lat * m_per_deg_lat +
                 deg_per_px_lon * m_per_deg_lon
@@ -659,10 +811,27 @@ class TerrainLayerGUI:
             self.dem_pixel_w = None
             self.dem_pixel_h = None
 
+    def _schedule_scale_update(self):
+        """入力中の連続変更はまとめて、最後の変更から150ms後に1回だけ再計算する"""
+        if getattr(self, '_scale_after', None):
+            self.root.after_cancel(self._scale_after)
+        self._scale_after = self.root.after(150, self._run_scale_update)
+
+    def _run_scale_update(self):
+        self._scale_after = None
+        self._update_scale_info()
+
     def _update_scale_info(self):
         """縮尺と1層厚さを計算してラベルに表示（PDF印刷時のフィット縮小を考慮）"""
         if not hasattr(self, 'scale_ratio_label'):
             return
+        # 入力が前回と同じならラベルを触らない
+        key = (self.dem_pixel_m, getattr(self, 'dem_pixel_w', None),
+               getattr(self, 'dem_pixel_h', None), self.scale_var.get(),
+               self.interval_var.get(), self.paper_size_var.get())
+        if key == self._scale_cache_key:
+            return
+        self._scale_cache_key = key
         if self.dem_pixel_m is None or self.dem_pixel_w is None:
             self.scale_ratio_label.config(text="— (GeoTIFF未選択)")
             self.layer_thick_label.config(text="—")
@@ -736,9 +905,34 @@ class TerrainLayerGUI:
             self._save_settings()
             
     def log(self, message):
-        self.progress_text.insert(tk.END, message + "\n")
-        self.progress_text.see(tk.END)
-        self.root.update()
+        self._log_queue.append(message)
+
+    def set_progress(self, percent, phase):
+        """進捗を更新（どのスレッドからでも可。percent=None ならバーはそのまま）"""
+        self._progress_latest.append((percent, phase))
+
+    def _flush_log(self):
+        """溜まったログを1回の insert で書き出し、最新の進捗を反映する（50ms ごと）"""
+        try:
+            percent, phase = self._progress_latest.popleft()
+        except IndexError:
+            pass
+        else:
+            if percent is not None:
+                self.progress_var.set(percent)
+            self.progress_phase.set(phase)
+        if self._log_queue:
+            batch = []
+            while self._log_queue and len(batch) < 200:
+                batch.append(self._log_queue.popleft())
+            self.progress_text.insert(tk.END, "\n".join(batch) + "\n")
+            # 長時間使っても Text が際限なく伸びないよう古い行を捨てる
+            lines = int(self.progress_text.index('end-1c').split('.')[0])
+            if lines > 2000:
+                self.progress_text.delete('1.0', f'{lines - 1500}.0')
+            self.progress_text.see(tk.END)
+            self.root.update_idletasks()
+        self.root.after(50, self._flush_log)
         
     def get_parameters(self):
         """UIから設定値を取得"""
@@ -772,6 +966,7 @@ class TerrainLayerGUI:
             
         try:
             self.log("ジェネレータを初期化中...")
+            from terrain_layering import TerrainLayerGenerator
             generator = TerrainLayerGenerator(
                 self.dem_file,
                 interval=params['interval'],
@@ -787,6 +982,28 @@ class TerrainLayerGUI:
             messagebox.showerror("エラー", f"ファイルの読み込みに失敗しました:\n{e}")
             return None
             
+    def _make_preview_key(self, params):
+        """プレビュー画像の内容を決める入力（出力先・用紙・スケールは無関係なので除く）。
+        同じパスに DEM を取り直した場合も別物と分かるよう、更新時刻とサイズも含める。"""
+        try:
+            st = os.stat(self.dem_file)
+            dem_id = (self.dem_file, st.st_mtime_ns, st.st_size)
+        except (OSError, TypeError):
+            dem_id = (self.dem_file, None, None)
+        return dem_id + tuple(
+            (k, v) for k, v in sorted(params.items())
+            if k not in ('output_dir', 'paper_size', 'scale'))
+
+    def schedule_preview(self):
+        """300ms 以内に続いた要求（ボタン連打など）はまとめて1回だけプレビューを生成する"""
+        if self._preview_after_id:
+            self.root.after_cancel(self._preview_after_id)
+        self._preview_after_id = self.root.after(300, self._run_preview_now)
+
+    def _run_preview_now(self):
+        self._preview_after_id = None
+        self.update_preview()
+
     def update_preview(self):
         """プレビューを更新"""
         generator = self.create_generator()
@@ -794,57 +1011,58 @@ class TerrainLayerGUI:
             return
 
         params = self.get_parameters()
+        preview_key = self._make_preview_key(params)
+
+        # 前のプレビューがまだタイル取得中なら打ち切る（古い結果で上書きしない）
+        if self._preview_cancel is not None:
+            self._preview_cancel.set()
+        cancel = self._preview_cancel = threading.Event()
 
         def preview_thread():
+            from terrain_layering import Cancelled
             try:
                 colormap = params['colormap']
                 is_tile_mode = colormap in ('satellite', 'gsi_topo')
 
-                self.root.after(0, lambda: (
-                    self.progress_var.set(0),
-                    self.progress_phase.set("タイル取得中..." if is_tile_mode else "描画中...")
-                ))
+                self.set_progress(0, "タイル取得中..." if is_tile_mode else "描画中...")
 
                 def on_tile_progress(done, total, msg):
-                    pct = done / total * 100
-                    self.root.after(0, lambda p=pct, m=msg: (
-                        self.progress_var.set(p),
-                        self.progress_phase.set(m)
-                    ))
+                    if cancel.is_set():
+                        raise Cancelled()
+                    self.set_progress(done / total * 100, msg)
 
                 self.log(f"プレビューを生成中 ({colormap})...")
-                import tempfile
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-                temp_path = temp_file.name
-                temp_file.close()
-
+                # 一時ファイルを経由せずメモリ上の PNG で受け渡す
+                import io
+                buf = io.BytesIO()
                 generator.preview(
                     colormap=colormap,
-                    output_file=temp_path,
+                    output_file=buf,
                     progress_callback=on_tile_progress if is_tile_mode else None,
                 )
+                if cancel.is_set():
+                    raise Cancelled()
 
-                self.root.after(0, lambda: (
-                    self.progress_var.set(100),
-                    self.progress_phase.set("完了")
-                ))
-                self.root.after(0, lambda: self.display_preview(temp_path))
+                self.set_progress(100, "完了")
+                buf.seek(0)
+                self.root.after(0, lambda: self.display_preview(buf, preview_key))
 
+            except Cancelled:
+                self.log("前のプレビューを中断しました")
             except Exception as e:
-                self.root.after(0, lambda: (
-                    self.progress_phase.set("エラー"),
-                    messagebox.showerror("エラー", f"プレビュー生成エラー:\n{e}")
-                ))
+                self.set_progress(None, "エラー")
+                self.root.after(0, lambda: messagebox.showerror("エラー", f"プレビュー生成エラー:\n{e}"))
 
         thread = threading.Thread(target=preview_thread, daemon=True)
         thread.start()
         
-    def display_preview(self, image_path):
-        """プレビュー画像を表示"""
+    def display_preview(self, image_file, preview_key=None):
+        """プレビュー画像（パスまたはファイルオブジェクト）を表示"""
         try:
             from PIL import Image
-            img = Image.open(image_path)
+            img = Image.open(image_file)
             self.preview_image = img  # リサイズ判定用に保持
+            self._preview_key = None  # 表示まで成功したら下で設定する
 
             # 初回: プレースホルダーを隠してcanvasを展開
             if not self._canvas_packed:
@@ -858,17 +1076,22 @@ class TerrainLayerGUI:
             if pw > 10 and ph > 10:
                 self.fig.set_size_inches(pw / self.fig.dpi, ph / self.fig.dpi)
 
-            self.ax.clear()
-            self.ax.imshow(img)
-            self.ax.axis('off')
-            self.fig.tight_layout(pad=0)
-            self.canvas.draw()
+            # 2回目以降は AxesImage を作り直さず画像だけ差し替える（Axes の再構築・再レイアウトをしない）
+            w, h = img.size
+            if self._preview_artist is None:
+                self._preview_artist = self.ax.imshow(img)
+                self.ax.axis('off')
+                self.fig.tight_layout(pad=0)
+            else:
+                self._preview_artist.set_data(img)
+                self._preview_artist.set_extent((-0.5, w - 0.5, h - 0.5, -0.5))
+                self.ax.set_xlim(-0.5, w - 0.5)
+                self.ax.set_ylim(h - 0.5, -0.5)
+            self.canvas.draw_idle()
 
+            self._preview_key = preview_key
             self.log("プレビュー更新完了")
 
-            import os
-            os.unlink(image_path)
-
         except Exception as e:
             messagebox.showerror("エラー", f"プレビュー表示エラー:\n{e}")
             
@@ -893,19 +1116,13 @@ class TerrainLayerGUI:
         def on_progress(current, total, phase):
             pct = current / total * 100
             label = f"輪郭計算 {current}/{total}" if phase == 'contour' else f"SVG生成 {current}/{total}"
-            # GUIスレッドへ安全に転送
-            self.root.after(0, lambda p=pct, l=label: (
-                self.progress_var.set(p),
-                self.progress_phase.set(l)
-            ))
+            # GUIへの反映は _flush_log のタイマーでまとめて行う
+            self.set_progress(pct, label)
 
         def generate_thread():
             try:
                 # リセット
-                self.root.after(0, lambda: (
-                    self.progress_var.set(0),
-                    self.progress_phase.set("開始中...")
-                ))
+                self.set_progress(0, "開始中...")
                 self.log(f"\n=== SVGレイヤー生成開始 ===")
                 self.log(f"出力先: {params['output_dir']}")
 
@@ -916,28 +1133,28 @@ class TerrainLayerGUI:
                     progress_callback=on_progress,
                 )
 
-                self.root.after(0, lambda: (
-                    self.progress_var.set(100),
-                    self.progress_phase.set("完了")
-                ))
+                self.set_progress(100, "完了")
 
-                self.log("プレビュー画像を生成中...")
                 preview_file = Path(params['output_dir']) / 'preview.png'
-                generator.preview(colormap=params['colormap'], output_file=str(preview_file))
+                preview_image = self.preview_image
+                if preview_image is not None and self._preview_key == self._make_preview_key(params):
+                    # 同じ条件で表示中のプレビューがあれば描き直さずに保存するだけ
+                    preview_image.save(str(preview_file))
+                else:
+                    self.log("プレビュー画像を生成中...")
+                    generator.preview(colormap=params['colormap'], output_file=str(preview_file))
 
                 self.log("\n=== 完了 ===")
                 self.log(f"出力先: {params['output_dir']}")
-                self._save_settings()
+                self.root.after(0, self._save_settings)   # Tk 変数を読むので GUI スレッドで
                 self.root.after(0, lambda: messagebox.showinfo(
                     "完了",
                     f"SVGファイルの生成が完了しました。\n\n出力先:\n{params['output_dir']}"
                 ))
 
             except Exception as e:
-                self.root.after(0, lambda: (
-                    self.progress_phase.set("エラー"),
-                    messagebox.showerror("エラー", f"生成エラー:\n{e}")
-                ))
+                self.set_progress(None, "エラー")
+                self.root.after(0, lambda: messagebox.showerror("エラー", f"生成エラー:\n{e}"))
                 import traceback
                 self.log(f"エラー: {traceback.format_exc()}")
 
@@ -951,7 +1168,7 @@ class TerrainLayerGUI:
             return
             
         output_dir = Path(params['output_dir'])
-        svg_files = sorted(output_dir.glob('layer_*.svg'))
+        svg_files = _list_layer_svgs(output_dir)
         
         if not svg_files:
             messagebox.showwarning(
@@ -986,48 +1203,14 @@ class TerrainLayerGUI:
     
     def _draw_cover_page(self, c, page_w, page_h, mm, params):
         """PDF表紙ページを描画（プレビュー画像＋タイトル・縮尺・1層厚さ）"""
-        import tempfile, os
         from reportlab.lib.units import mm as _mm
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
 
         MARGIN = 15 * mm
 
-        # ── 日本語対応フォントを探して登録 ──────────────────────────────
-        JP_FONT = 'Helvetica-Bold'   # フォールバック
-        JP_FONT_PLAIN = 'Helvetica'
-        _candidates = []
-        import platform
-        if platform.system() == 'Windows':
-            _candidates = [
-                r'C:\Windows\Fonts\msgothic.ttc',
-                r'C:\Windows\Fonts\meiryo.ttc',
-                r'C:\Windows\Fonts\YuGothM.ttc',
-            ]
-        elif platform.system() == 'Darwin':
-            _candidates = [
-                '/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc',
-                '/Library/Fonts/Osaka.ttf',
-            ]
-        else:
-            _candidates = [
-                '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
-                '/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc',
-            ]
-        for _fp in _candidates:
-            if os.path.exists(_fp):
-                try:
-                    # ttcの場合はサブフォント0番を使用
-                    pdfmetrics.registerFont(TTFont('JPFont', _fp, subfontIndex=0))
-                    JP_FONT = JP_FONT_PLAIN = 'JPFont'
-                except Exception:
-                    try:
-                        pdfmetrics.registerFont(TTFont('JPFont', _fp))
-                        JP_FONT = JP_FONT_PLAIN = 'JPFont'
-                    except Exception:
-                        pass
-                if JP_FONT == 'JPFont':
-                    break
+        # ── 日本語対応フォント（登録はプロセスで1回だけ） ────────────────
+        _jp = _register_jp_font()
+        JP_FONT = _jp or 'Helvetica-Bold'   # フォールバック
+        JP_FONT_PLAIN = _jp or 'Helvetica'
 
         def safe_draw_string(canvas_obj, x, y, text, font, size):
             """日本語フォントがあればそのまま、なければASCII外を?に置換して描画"""
@@ -1040,12 +1223,9 @@ class TerrainLayerGUI:
         # ── プレビュー画像を背景に描画 ─────────────────────────────────
         preview_drawn = False
         if self.preview_image is not None:
-            preview_tmp = None
             try:
-                fd, preview_tmp = tempfile.mkstemp(suffix='.png')
-                os.close(fd)
-                self.preview_image.save(preview_tmp)
-
+                # PIL画像をそのまま渡す（一時PNGへの書き出し・再読み込みをしない）
+                from reportlab.lib.utils import ImageReader
                 img_w_px, img_h_px = self.preview_image.size
                 img_aspect = img_w_px / img_h_px
 
@@ -1062,16 +1242,20 @@ class TerrainLayerGUI:
                 img_x = (page_w - fit_w) / 2
                 img_y = MARGIN
 
-                c.drawImage(preview_tmp, img_x, img_y,
+                # 枠に対して大きすぎる画像は印刷に十分な 200dpi 相当まで縮小してから埋め込む
+                cover_img = self.preview_image
+                tw = max(1, int(fit_w / 72 * 200))
+                th = max(1, int(fit_h / 72 * 200))
+                if img_w_px > 2 * tw:
+                    from PIL import Image
+                    cover_img = cover_img.resize((tw, th), Image.LANCZOS)
+
+                c.drawImage(ImageReader(cover_img), img_x, img_y,
                             width=fit_w, height=fit_h,
                             preserveAspectRatio=True)
                 preview_drawn = True
             except Exception as e:
                 self.log(f"  表紙プレビュー画像エラー: {e}")
-            finally:
-                if preview_tmp and os.path.exists(preview_tmp):
-                    try: os.unlink(preview_tmp)
-                    except Exception: pass
 
         if not preview_drawn:
             # プレビューなし → グレー枠＋メッセージ
@@ -1127,7 +1311,6 @@ class TerrainLayerGUI:
             self.log("\n=== PDF生成開始 ===")
             
             from svglib.svglib import svg2rlg
-            from reportlab.graphics import renderPDF
             from reportlab.pdfgen import canvas
             from reportlab.lib.pagesizes import A4, A3, B4
             from reportlab.lib.units import mm
@@ -1168,80 +1351,100 @@ class TerrainLayerGUI:
             self._draw_cover_page(c, cover_page_width, cover_page_height, mm, params)
             c.showPage()
 
-            for i, svg_file in enumerate(svg_files, 1):
-                self.log(f"[{i}/{len(svg_files)}] {svg_file.name} を変換中...")
+            # 用紙の向きは縦・横の2通りしかないので、ページ寸法と描画可能域（各辺10mm
+            # のマージンを除く）は先に両方計算しておく
+            margin = 10 * mm
+            page_aspect = page_width / page_height
+            page_geom = {
+                use_landscape: (w, h, w - 2 * margin, h - 2 * margin)
+                for use_landscape, (w, h) in ((False, (page_width, page_height)),
+                                              (True,  (page_height, page_width)))
+            }
+
+            # 前回から変わっていない SVG はキャッシュから取り出すので、解析するのは残りだけ
+            import pickle
+            keys = [_drawing_cache_key(f) for f in svg_files]
+            for k in set(_drawing_cache) - set(keys):   # 今回使わない分は捨てる
+                del _drawing_cache[k]
+            todo = [str(f) for f, k in zip(svg_files, keys) if k not in _drawing_cache]
+
+            # SVG → Drawing の変換（svglib の XML 解析）は CPU 律速なのでプロセスに分散し、
+            # canvas への描画だけをこのスレッドで順番に行う（canvas はスレッドセーフでない）
+            workers = min(os.cpu_count() or 1, len(todo))
+            pool = None
+            if workers > 1:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context('spawn'))
+                drawings = pool.map(_svg_to_drawing, todo, chunksize=4)
+            else:
+                drawings = map(_svg_to_drawing, todo)
+
+            try:
+                for i, (svg_file, key) in enumerate(zip(svg_files, keys), 1):
+                    self.log(f"[{i}/{len(svg_files)}] {svg_file.name} を変換中...")
                 
-                try:
-                    # SVGをReportLab Drawing objectに変換
-                    drawing = svg2rlg(str(svg_file))
-                    
-                    if drawing:
-                        # SVGのサイズを取得
-                        svg_width = drawing.width
-                        svg_height = drawing.height
-                        
-                        # SVGと用紙のアスペクト比を比較
-                        svg_aspect = svg_width / svg_height
-                        page_aspect = page_width / page_height
-                        
-                        # 用紙を最大限活用するために向きを決定
-                        use_landscape = False
-                        
-                        if svg_aspect > 1.0 and page_aspect < 1.0:
-                            # SVGが横長、用紙が縦長 → 用紙を横向きに
-                            use_landscape = True
-                        elif svg_aspect < 1.0 and page_aspect > 1.0:
-                            # SVGが縦長、用紙が横長 → 用紙を縦向きに（通常と逆）
-                            use_landscape = True
-                        
-                        # 現在のページサイズを決定
-                        if use_landscape:
-                            current_page_width = page_height
-                            current_page_height = page_width
-                            self.log(f"  → 横向き配置 ({current_page_width:.0f}x{current_page_height:.0f})")
+                    try:
+                        # SVGをReportLab Drawing objectに変換
+                        if key in _drawing_cache:
+                            drawing = pickle.loads(_drawing_cache[key])
                         else:
-                            current_page_width = page_width
-                            current_page_height = page_height
-                        
-                        # ページサイズを設定（最初のページも含む）
-                        c.setPageSize((current_page_width, current_page_height))
-                        
-                        # マージンを考慮（各辺10mm）
-                        margin = 10 * mm
-                        available_width = current_page_width - 2 * margin
-                        available_height = current_page_height - 2 * margin
+                            drawing, err = next(drawings)
+                            if err is not None:
+                                raise RuntimeError(err)
+                            if drawing is not None and key is not None:
+                                _drawing_cache[key] = pickle.dumps(drawing, pickle.HIGHEST_PROTOCOL)
+                    
+                        if drawing:
+                            # SVGのサイズを取得
+                            svg_width = drawing.width
+                            svg_height = drawing.height
                         
-                        # アスペクト比を保ちながらフィット
-                        scale_x = available_width / svg_width
-                        scale_y = available_height / svg_height
-                        scale = min(scale_x, scale_y)
+                            # SVGと用紙の向きが違えば用紙を90°回転して最大限活用する
+                            use_landscape = (svg_width / svg_height > 1.0) != (page_aspect > 1.0)
+                            (current_page_width, current_page_height,
+                             available_width, available_height) = page_geom[use_landscape]
+                            if use_landscape:
+                                self.log(f"  → 横向き配置 ({current_page_width:.0f}x{current_page_height:.0f})")
+
+                            # ページサイズを設定（最初のページも含む）
+                            c.setPageSize((current_page_width, current_page_height))
+
+                            # アスペクト比を保ちながらフィット
+                            scale = min(available_width / svg_width, available_height / svg_height)
                         
-                        # スケーリング適用
-                        drawing.width = svg_width * scale
-                        drawing.height = svg_height * scale
-                        drawing.scale(scale, scale)
+                            # スケーリング適用
+                            drawing.width = svg_width * scale
+                            drawing.height = svg_height * scale
+                            drawing.scale(scale, scale)
                         
-                        # 中央配置
-                        x = (current_page_width - drawing.width) / 2
-                        y = (current_page_height - drawing.height) / 2
+                            # 中央配置
+                            x = (current_page_width - drawing.width) / 2
+                            y = (current_page_height - drawing.height) / 2
                         
-                        # PDFに描画
-                        renderPDF.draw(drawing, c, x, y)
+                            # PDFに描画
+                            for img in _draw_layer(drawing, c, x, y):
+                                self.log(f"  警告: 画像が見つかりません: {img}")
                         
-                        # ページ情報を追加
-                        c.setFont("Helvetica", 10)
-                        c.drawString(margin, margin / 2, 
-                                   f"Layer {i}/{len(svg_files)}: {svg_file.stem}")
+                            # ページ情報を追加
+                            c.setFont("Helvetica", 10)
+                            c.drawString(margin, margin / 2, 
+                                       f"Layer {i}/{len(svg_files)}: {svg_file.stem}")
                         
-                        # 次のページへ（最後のページ以外）
-                        if i < len(svg_files):
-                            c.showPage()
-                    else:
-                        self.log(f"  警告: {svg_file.name} の変換に失敗")
+                            # 次のページへ（最後のページ以外）
+                            if i < len(svg_files):
+                                c.showPage()
+                        else:
+                            self.log(f"  警告: {svg_file.name} の変換に失敗")
                         
-                except Exception as e:
-                    self.log(f"  エラー: {svg_file.name} - {e}")
-                    continue
+                    except Exception as e:
+                        self.log(f"  エラー: {svg_file.name} - {e}")
+                        continue
+            finally:
+                # 途中で例外が出てもワーカープロセスを残さない
+                if pool is not None:
+                    pool.shutdown(cancel_futures=True)
             
             # PDFを保存
             c.save()
@@ -1324,7 +1527,7 @@ class TerrainLayerGUI:
             return
             
         output_dir = Path(params['output_dir'])
-        svg_files = sorted(output_dir.glob('layer_*.svg'))
+        svg_files = _list_layer_svgs(output_dir)
         
         if not svg_files:
             messagebox.showwarning(
@@ -1366,6 +1569,9 @@ class TerrainLayerGUI:
 
 
 def main():
+    # PDF生成のワーカープロセス（spawn）を EXE 化した環境でも起動できるように
+    import multiprocessing
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = TerrainLayerGUI(root)
     root.mainloop()